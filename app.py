@@ -2,14 +2,24 @@
 """Video Downloader Web App using yt-dlp"""
 
 import os
+import hashlib
+import mimetypes
+import shutil
+import sqlite3
 import subprocess
-import json
-import re
 import threading
 import secrets
 import time
-from urllib.parse import urlparse
-from flask import Flask, render_template, request, jsonify, send_from_directory, abort
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict, astuple, fields
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import quote, urlparse
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, abort
+import yt_dlp
+from yt_dlp.postprocessor import PostProcessor
+from yt_dlp.utils import DownloadError
 
 app = Flask(__name__)
 
@@ -89,17 +99,70 @@ ALLOWED_DOMAINS = [
     'crunchyroll.com', 'www.crunchyroll.com',
 ]
 
-VALID_FORMATS = {'best', '1080p', '720p', '480p'}
+# Longer URLs are rejected outright rather than parsed and cached
+MAX_URL_LENGTH = 2048
+
+# Hash set for O(1) lookups of a hostname and each of its parent domains
+ALLOWED_SET = frozenset(d.lower() for d in ALLOWED_DOMAINS)
+
+# yt-dlp format selectors per quality option. Prefer H.264 (avc1) codec for
+# QuickTime compatibility, falling back to any format if H.264 not available
+FORMAT_SELECTORS = {
+    'best': 'bestvideo[vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[vcodec^=avc1]+bestaudio/best[vcodec^=avc1]/bestvideo+bestaudio/best',
+    '1080p': 'bestvideo[height<=1080][vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[height<=1080][vcodec^=avc1]+bestaudio/best[height<=1080][vcodec^=avc1]/bestvideo[height<=1080]+bestaudio/best[height<=1080]',
+    '720p': 'bestvideo[height<=720][vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[height<=720][vcodec^=avc1]+bestaudio/best[height<=720][vcodec^=avc1]/bestvideo[height<=720]+bestaudio/best[height<=720]',
+    '480p': 'bestvideo[height<=480][vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[height<=480][vcodec^=avc1]+bestaudio/best[height<=480][vcodec^=avc1]/bestvideo[height<=480]+bestaudio/best[height<=480]',
+}
+
+VALID_FORMATS = frozenset(FORMAT_SELECTORS)
+
+# Codecs QuickTime plays from an MP4 container as-is (stream copy, no re-encode)
+MP4_VIDEO_CODECS = ('avc1', 'h264')
+MP4_AUDIO_CODECS = ('mp4a', 'aac', 'mp3')
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# yt-dlp options shared by info lookups and downloads
+YDL_BASE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'nocheckcertificate': True,
+    'geo_bypass': True,
+    'http_headers': {'User-Agent': USER_AGENT},
+}
+
+
+@lru_cache(maxsize=1024)
+def _is_allowed(hostname):
+    """Check a hostname and each parent domain (a.b.c -> a.b.c, b.c) against ALLOWED_SET"""
+    while '.' in hostname:
+        if hostname in ALLOWED_SET:
+            return True
+        hostname = hostname.partition('.')[2]
+    return False
 
 
 def is_valid_video_url(url):
     """Validate that URL is from an allowed video platform."""
+    # Reject over-long URLs before they can be kept in the cache
+    if len(url) > MAX_URL_LENGTH:
+        return False
+    return _is_valid_video_url(url)
+
+
+@lru_cache(maxsize=4096)
+def _is_valid_video_url(url):
+    """Cached URL check behind is_valid_video_url"""
     try:
         parsed = urlparse(url)
         if parsed.scheme not in ('http', 'https'):
             return False
-        domain = parsed.netloc.lower()
-        return any(domain == d or domain.endswith('.' + d) for d in ALLOWED_DOMAINS)
+        # hostname is lowercased and excludes userinfo and port
+        domain = parsed.hostname
+        if not domain:
+            return False
+        return _is_allowed(domain)
     except Exception:
         return False
 
@@ -121,34 +184,289 @@ def get_safe_filepath(filename):
     """Get safe filepath within DOWNLOAD_DIR, returns None if unsafe."""
     if not is_safe_filename(filename):
         return None
-    filepath = os.path.join(DOWNLOAD_DIR, filename)
-    # Double-check with realpath
-    real_download_dir = os.path.realpath(DOWNLOAD_DIR)
-    real_filepath = os.path.realpath(filepath)
-    if not real_filepath.startswith(real_download_dir + os.sep):
+    # is_safe_filename already rejects separators and '..', so normalizing
+    # against the resolved directory is enough for the containment check
+    filepath = os.path.normpath(os.path.join(REAL_DOWNLOAD_DIR, filename))
+    if not filepath.startswith(REAL_DOWNLOAD_DIR + os.sep):
         return None
     return filepath
 
 
-# Store download progress
-downloads = {}
+@dataclass(frozen=True, slots=True)
+class Progress:
+    """Immutable snapshot of a download's state"""
+    status: str
+    progress: int = 0
+    filename: Optional[str] = None
+    error: Optional[str] = None
+
+
+PROGRESS_FIELDS = tuple(f.name for f in fields(Progress))
+
 DOWNLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
 COOKIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cookies.txt')
 
+# Download progress lives in SQLite (WAL mode) rather than process memory, so
+# every gunicorn worker sees every download. Finished entries expire after an
+# hour; unfinished ones only after a day, to clear out those orphaned by a
+# killed worker without dropping slow queued or converting downloads.
+STATE_DB = os.environ.get('STATE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state.db'))
+STATE_TTL = 3600
+STATE_ORPHAN_TTL = 86400
+
 # Ensure download directory exists
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+REAL_DOWNLOAD_DIR = os.path.realpath(DOWNLOAD_DIR)
+
+# Optionally let the front-end proxy send file bytes instead of a Flask worker:
+# X_ACCEL_REDIRECT_PREFIX is an nginx `internal` location aliased to DOWNLOAD_DIR,
+# USE_X_SENDFILE=1 enables X-Sendfile for Apache/lighttpd mod_xsendfile
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '').rstrip('/')
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Pool limits below are for the whole app. Under gunicorn each worker process
+# takes an equal share (rounded up) of them; gunicorn.conf.py passes the
+# process count in WORKER_PROCESSES
+WORKER_PROCESSES = max(1, int(os.environ.get('WORKER_PROCESSES', '1')))
+
+
+def per_process(limit):
+    """Split an app-wide limit across worker processes, at least 1 each"""
+    return max(1, -(-limit // WORKER_PROCESSES))
+
+
+# Bounded download workers; requests beyond MAX_PENDING_DOWNLOADS
+# (queued, downloading or converting) are rejected instead of piling up
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '3'))
+MAX_PENDING_DOWNLOADS = int(os.environ.get('MAX_PENDING_DOWNLOADS', '20'))
+download_pool = ThreadPoolExecutor(max_workers=per_process(DOWNLOAD_WORKERS), thread_name_prefix='download')
+download_slots = threading.BoundedSemaphore(per_process(MAX_PENDING_DOWNLOADS))
+
+# ffmpeg is optional; without it downloads are kept in their original codec
+FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
+# ffprobe is only needed when yt-dlp doesn't report the downloaded codecs
+FFPROBE_AVAILABLE = shutil.which('ffprobe') is not None
+
+# Hardware H.264 encoders, preferred in this order over libx264
+HW_H264_ENCODERS = ('h264_videotoolbox', 'h264_nvenc', 'h264_qsv')
+
+
+def h264_video_args(encoder):
+    """Return ffmpeg video encoding arguments for the given H.264 encoder"""
+    # 8-bit 4:2:0 output: QuickTime can't play High 10/4:4:4 H.264, and most
+    # hardware encoders reject 10-bit input (e.g. YouTube VP9.2/AV1)
+    if encoder == 'libx264':
+        return ['-c:v', 'libx264', '-preset', 'fast', '-crf', '22', '-pix_fmt', 'yuv420p']
+    # Hardware encoders don't share libx264's CRF scale, use a target bitrate
+    return ['-c:v', encoder, '-b:v', '4M', '-pix_fmt', 'yuv420p']
+
+
+def h264_encoder_works(encoder):
+    """Check that ffmpeg can actually encode a test frame with the given encoder"""
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+             '-f', 'lavfi', '-i', 'color=s=256x256', '-frames:v', '1',
+             *h264_video_args(encoder), '-f', 'null', '-'],
+            capture_output=True, timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
 
 
-def get_cookies_args():
-    """Return yt-dlp cookie arguments if cookies file exists"""
+def detect_h264_encoder():
+    """Pick the H.264 encoder to use, asking ffmpeg once which it supports.
+
+    Listed hardware encoders are confirmed with a one-frame test encode, since
+    builds often list NVENC/QSV on hosts without the hardware.
+    """
+    override = os.environ.get('H264_ENCODER')
+    if override:
+        return override
+    if not FFMPEG_AVAILABLE:
+        return 'libx264'
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return 'libx264'
+    # Lines look like " V....D h264_nvenc           NVIDIA NVENC H.264 encoder"
+    available = {fields[1] for fields in map(str.split, result.stdout.splitlines()) if len(fields) > 1}
+    for encoder in HW_H264_ENCODERS:
+        if encoder in available and h264_encoder_works(encoder):
+            return encoder
+    return 'libx264'
+
+
+H264_ENCODER = detect_h264_encoder()
+
+
+def probe_codecs(filepath):
+    """Return (vcodec, acodec) of a file via ffprobe; 'none' for a missing stream, None if unknown"""
+    if not FFPROBE_AVAILABLE:
+        return None, None
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name',
+             '-of', 'csv=p=0', filepath],
+            capture_output=True, text=True, timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None, None
+    if result.returncode != 0:
+        return None, None
+    # Lines look like "h264,video" / "aac,audio"; keep the first of each type
+    codecs = {}
+    for line in result.stdout.splitlines():
+        name, _, codec_type = line.partition(',')
+        codecs.setdefault(codec_type, name)
+    return codecs.get('video', 'none'), codecs.get('audio', 'none')
+
+
+# ffmpeg re-encodes are CPU-bound, so they run on their own smaller pool and
+# never hold a download worker while they wait on the encoder
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+convert_pool = ThreadPoolExecutor(max_workers=per_process(CONVERT_WORKERS), thread_name_prefix='convert')
+
+
+def get_cookies_opts():
+    """Return yt-dlp cookie options if cookies file exists"""
     if os.path.isfile(COOKIES_FILE):
-        return ['--cookies', COOKIES_FILE]
-    return []
+        return {'cookiefile': COOKIES_FILE}
+    return {}
+
+
+# Per-thread YoutubeDL instances for info lookups (YoutubeDL is not thread-safe)
+_info_ydl = threading.local()
+
+
+def get_cookies_digest():
+    """Return a hash of the cookies file contents, or None if there is none"""
+    try:
+        with open(COOKIES_FILE, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def get_info_ydl():
+    """Return this thread's reusable YoutubeDL for info lookups.
+
+    The instance is rebuilt when the cookies file contents are added, changed
+    or removed. Downloads write their cookie jar back to the file when they
+    finish, so an mtime change alone only triggers a content comparison.
+    """
+    try:
+        cookies_mtime = os.stat(COOKIES_FILE).st_mtime_ns
+    except OSError:
+        cookies_mtime = None
+
+    instance = getattr(_info_ydl, 'instance', None)
+    if instance is not None and _info_ydl.cookies_mtime == cookies_mtime:
+        return instance
+
+    cookies_digest = get_cookies_digest()
+    _info_ydl.cookies_mtime = cookies_mtime
+    if instance is not None and _info_ydl.cookies_digest == cookies_digest:
+        return instance
+
+    if instance is not None:
+        # Close without saving: the old jar must not overwrite the new cookies
+        instance.params['cookiefile'] = None
+        instance.close()
+
+    opts = dict(
+        YDL_BASE_OPTS,
+        skip_download=True,
+        socket_timeout=60,
+        extractor_args={'youtube': {'player_client': ['default']}},
+    )
+    opts.update(get_cookies_opts())
+    _info_ydl.instance = yt_dlp.YoutubeDL(opts)
+    _info_ydl.cookies_digest = cookies_digest
+    return _info_ydl.instance
+
+
+# Per-thread connections to STATE_DB (sqlite3 connections are not shared across threads)
+_state_db = threading.local()
+
+
+def get_state_db():
+    """Return this thread's connection to the download state database"""
+    conn = getattr(_state_db, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _state_db.conn = conn
+    return conn
+
+
+# Create the state table on startup (safe to run from several workers at once)
+get_state_db().execute("""
+    CREATE TABLE IF NOT EXISTS downloads (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        progress INTEGER NOT NULL,
+        filename TEXT,
+        error TEXT,
+        updated REAL NOT NULL
+    )
+""")
+
+
+def save_progress(download_id, progress):
+    """Store a fresh progress snapshot for a download, expiring stale ones"""
+    now = time.time()
+    conn = get_state_db()
+    conn.execute(
+        "DELETE FROM downloads WHERE (status IN ('completed', 'error') AND updated < ?) OR updated < ?",
+        (now - STATE_TTL, now - STATE_ORPHAN_TTL)
+    )
+    conn.execute(
+        f'INSERT OR REPLACE INTO downloads (id, {", ".join(PROGRESS_FIELDS)}, updated) '
+        f'VALUES ({", ".join("?" * (len(PROGRESS_FIELDS) + 2))})',
+        (download_id, *astuple(progress), now)
+    )
+
+
+def set_progress(download_id, **changes):
+    """Update the given fields of a download's progress snapshot"""
+    unknown = set(changes) - set(PROGRESS_FIELDS)
+    if unknown:
+        raise TypeError(f'Unknown progress fields: {", ".join(sorted(unknown))}')
+    assignments = ', '.join(f'{name} = ?' for name in changes)
+    cursor = get_state_db().execute(
+        f'UPDATE downloads SET {assignments}, updated = ? WHERE id = ?',
+        (*changes.values(), time.time(), download_id)
+    )
+    if cursor.rowcount == 0:
+        # The row was expired or never saved. Only a status change says what
+        # state the download is in, so recreate the row for those alone; a
+        # bare progress tick would otherwise resurrect it with a guessed status
+        if 'status' in changes:
+            save_progress(download_id, Progress(**changes))
+        else:
+            print(f"Dropped progress update for unknown download {download_id}: {changes}")
+
+
+def load_progress(download_id):
+    """Return a download's progress snapshot, or None if unknown or expired"""
+    row = get_state_db().execute(
+        f'SELECT {", ".join(PROGRESS_FIELDS)} FROM downloads WHERE id = ?',
+        (download_id,)
+    ).fetchone()
+    return Progress(*row) if row else None
+
+
+# Translation table deleting characters that are invalid in filenames
+_FILENAME_STRIP = str.maketrans('', '', '<>:"/\\|?*')
 
 
 def sanitize_filename(filename):
     """Remove invalid characters from filename"""
-    return re.sub(r'[<>:"/\\|?*]', '', filename)
+    return filename.translate(_FILENAME_STRIP)
 
 
 def get_video_info(url, retries=3):
@@ -163,39 +481,18 @@ def get_video_info(url, retries=3):
             if attempt > 0:
                 time.sleep(2 ** attempt)  # 2s, 4s between retries
 
-            cmd = [
-                'yt-dlp',
-                '--dump-json',
-                '--no-download',
-                '--no-check-certificates',
-                '--geo-bypass',
-                '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                '--extractor-args', 'youtube:player_client=default',
-            ]
-            cmd.extend(get_cookies_args())
-            cmd.extend(['--', url])
-
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
-            if result.returncode == 0:
-                return json.loads(result.stdout)
+            return get_info_ydl().extract_info(url, download=False)
 
+        except DownloadError as e:
             # Check if it's a rate limit error
-            error_msg = result.stderr[:300] if result.stderr else 'Unknown error'
+            error_msg = str(e)[:300]
             last_error = error_msg
             print(f"yt-dlp error (attempt {attempt + 1}): {error_msg}")
 
-            # Don't retry if it's not a rate limit
-            if '429' not in error_msg and 'Too Many' not in error_msg:
+            # Don't retry if it's not a rate limit or timeout
+            if '429' not in error_msg and 'Too Many' not in error_msg and 'timed out' not in error_msg:
                 break
 
-        except subprocess.TimeoutExpired:
-            last_error = 'Timeout'
-            continue
         except Exception as e:
             last_error = str(e)
             break
@@ -203,19 +500,37 @@ def get_video_info(url, retries=3):
     return {'error': 'Failed to fetch video information. YouTube may be rate-limiting this server.', 'debug': last_error}
 
 
+class RecordDownloadParts(PostProcessor):
+    """Record the formats about to be downloaded and their share of 0-70%.
+
+    A merged selection (e.g. bestvideo+bestaudio) downloads one part per
+    format; shares follow the reported sizes when all are known.
+    """
+
+    def __init__(self, parts):
+        super().__init__()
+        self.parts = parts
+
+    def run(self, info):
+        formats = info.get('requested_formats') or [info]
+        sizes = [f.get('filesize') or f.get('filesize_approx') or 0 for f in formats]
+        if not all(sizes):
+            sizes = [1] * len(formats)
+        total = sum(sizes)
+        self.parts[:] = [(f.get('format_id'), 70 * size / total) for f, size in zip(formats, sizes)]
+        return [], info
+
+
 def download_video(url, download_id, format_option='best', audio_only=False):
-    """Download video in background thread"""
-    downloads[download_id] = {
-        'status': 'downloading',
-        'progress': 0,
-        'filename': None,
-        'error': None
-    }
+    """Download video in background thread.
+
+    Returns the convert_pool future when the file was handed off for conversion.
+    """
+    save_progress(download_id, Progress(status='downloading'))
 
     # Validate URL before processing
     if not is_valid_video_url(url):
-        downloads[download_id]['status'] = 'error'
-        downloads[download_id]['error'] = 'Invalid or unsupported video URL'
+        set_progress(download_id, status='error', error='Invalid or unsupported video URL')
         return
 
     # Validate format option
@@ -223,164 +538,212 @@ def download_video(url, download_id, format_option='best', audio_only=False):
         format_option = 'best'
 
     try:
-        # Build command with options to help avoid bot detection
-        cmd = [
-            'yt-dlp',
-            '--newline',
-            '--progress',
-            '--no-check-certificates',
-            '--geo-bypass',
-            '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            '--extractor-args', 'youtube:player_client=web,default;youtube:player_skip=webpage',
-        ]
-        cmd.extend(get_cookies_args())
+        last_pct = 0
+        # (format_id, share of the 0-70% download range) per part, recorded
+        # just before downloading
+        parts = []
+
+        def progress_hook(d):
+            nonlocal last_pct
+            if d['status'] == 'finished':
+                fraction = 1
+            elif d['status'] == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    fraction = d.get('downloaded_bytes', 0) / total
+                elif d.get('fragment_count'):
+                    # Fragmented (HLS/DASH) streams may not report a size
+                    fraction = d.get('fragment_index', 0) / d['fragment_count']
+                else:
+                    return
+            else:
+                return
+            # Offset by the parts already downloaded (video before audio)
+            format_id = d.get('info_dict', {}).get('format_id')
+            start, share = 0, 70
+            for part_id, part_share in parts:
+                if part_id == format_id:
+                    share = part_share
+                    break
+                start += part_share
+            else:
+                start = 0
+            pct = min(int(start + min(fraction, 1) * share), 70)  # 70% for download
+            # Only publish when the whole percent moves forward
+            if pct > last_pct:
+                last_pct = pct
+                set_progress(download_id, progress=pct)
+
+        # Options to help avoid bot detection
+        ydl_opts = dict(
+            YDL_BASE_OPTS,
+            extractor_args={'youtube': {'player_client': ['web', 'default'], 'player_skip': ['webpage']}},
+            outtmpl=os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s'),
+            progress_hooks=[progress_hook],
+        )
+        ydl_opts.update(get_cookies_opts())
 
         if audio_only:
-            cmd.extend(['-x', '--audio-format', 'mp3'])
-            output_template = os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s')
+            ydl_opts['format'] = 'bestaudio/best'
+            ydl_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}]
         else:
-            # Prefer H.264 (avc1) codec for QuickTime compatibility
-            # Fallback to any format if H.264 not available
-            if format_option == 'best':
-                cmd.extend(['-f', 'bestvideo[vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[vcodec^=avc1]+bestaudio/best[vcodec^=avc1]/bestvideo+bestaudio/best'])
-            elif format_option == '1080p':
-                cmd.extend(['-f', 'bestvideo[height<=1080][vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[height<=1080][vcodec^=avc1]+bestaudio/best[height<=1080][vcodec^=avc1]/bestvideo[height<=1080]+bestaudio/best[height<=1080]'])
-            elif format_option == '720p':
-                cmd.extend(['-f', 'bestvideo[height<=720][vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[height<=720][vcodec^=avc1]+bestaudio/best[height<=720][vcodec^=avc1]/bestvideo[height<=720]+bestaudio/best[height<=720]'])
-            elif format_option == '480p':
-                cmd.extend(['-f', 'bestvideo[height<=480][vcodec^=avc1]+bestaudio[acodec^=mp4a]/bestvideo[height<=480][vcodec^=avc1]+bestaudio/best[height<=480][vcodec^=avc1]/bestvideo[height<=480]+bestaudio/best[height<=480]'])
-
-            cmd.extend(['--merge-output-format', 'mp4'])
-            output_template = os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s')
-
-        # Use '--' to prevent URL from being interpreted as options
-        cmd.extend(['-o', output_template, '--', url])
-
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True
-        )
-
-        filename = None
-        error_output = []
-        for line in process.stdout:
-            line = line.strip()
-
-            # Capture potential error messages
-            if 'ERROR' in line or 'error' in line.lower():
-                error_output.append(line)
-
-            # Parse progress
-            if '[download]' in line:
-                # Match percentage
-                match = re.search(r'(\d+\.?\d*)%', line)
-                if match:
-                    downloads[download_id]['progress'] = float(match.group(1)) * 0.7  # 70% for download
+            ydl_opts['format'] = FORMAT_SELECTORS[format_option]
+            ydl_opts['merge_output_format'] = 'mp4'
 
-                # Match destination filename
-                if 'Destination:' in line:
-                    filename = line.split('Destination:')[-1].strip()
-
-            # Merger output
-            if '[Merger]' in line or '[ExtractAudio]' in line:
-                downloads[download_id]['progress'] = 70
-
-        process.wait()
-
-        if process.returncode != 0:
-            downloads[download_id]['status'] = 'error'
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.add_post_processor(RecordDownloadParts(parts), when='before_dl')
+                info = ydl.extract_info(url, download=True)
+        except DownloadError as e:
             # Provide more helpful error message
-            if error_output:
-                error_msg = error_output[-1][:100]  # Last error, truncated
-                if 'Sign in' in error_msg or 'bot' in error_msg.lower():
-                    downloads[download_id]['error'] = 'Video requires authentication or is blocked'
-                else:
-                    downloads[download_id]['error'] = f'Download failed: {error_msg}'
+            error_msg = str(e)[:100]  # Truncated
+            if 'Sign in' in error_msg or 'bot' in error_msg.lower():
+                error = 'Video requires authentication or is blocked'
             else:
-                downloads[download_id]['error'] = 'Download failed - video may be unavailable'
+                error = f'Download failed: {error_msg}'
+            set_progress(download_id, status='error', error=error)
             return
 
-        # Find the downloaded file
+        # Find the downloaded file (final path after merging/extraction)
         downloaded_file = None
-        if filename:
-            base = os.path.splitext(filename)[0]
-            for ext in ['.mp4', '.webm', '.mkv', '.mp3']:
-                check_path = base + ext
-                if os.path.exists(check_path):
-                    downloaded_file = check_path
-                    break
+        requested = (info or {}).get('requested_downloads') or [{}]
+        filepath = requested[0].get('filepath')
+        if filepath and os.path.exists(filepath):
+            downloaded_file = filepath
 
         # For audio only, we're done
         if audio_only:
-            downloads[download_id]['status'] = 'completed'
-            downloads[download_id]['progress'] = 100
-            if downloaded_file:
-                downloads[download_id]['filename'] = os.path.basename(downloaded_file)
+            set_progress(
+                download_id,
+                status='completed',
+                progress=100,
+                filename=os.path.basename(downloaded_file) if downloaded_file else None
+            )
             return
 
         # Convert to H.264 for QuickTime compatibility (optional - skip if ffmpeg not available)
         if downloaded_file:
-            downloads[download_id]['progress'] = 75
-
-            # Check if ffmpeg is available
-            ffmpeg_available = subprocess.run(['which', 'ffprobe'], capture_output=True).returncode == 0
-
-            if ffmpeg_available:
-                # Check if already H.264
-                probe_cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-                            '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', downloaded_file]
-                probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
-                codec = probe_result.stdout.strip()
-
-                if codec != 'h264':
-                    # Need to convert
-                    output_file = os.path.splitext(downloaded_file)[0] + '_converted.mp4'
-
-                    convert_cmd = [
-                        'ffmpeg', '-i', downloaded_file,
-                        '-c:v', 'libx264', '-preset', 'fast', '-crf', '22',
-                        '-c:a', 'aac', '-b:a', '192k',
-                        '-movflags', '+faststart',
-                        '-y', output_file
-                    ]
-
-                    convert_process = subprocess.Popen(
-                        convert_cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        text=True
-                    )
-
-                    # Monitor conversion progress
-                    for line in convert_process.stdout:
-                        if 'frame=' in line:
-                            downloads[download_id]['progress'] = 85
-
-                    convert_process.wait()
-
-                    if convert_process.returncode == 0:
-                        # Remove original, rename converted
-                        os.remove(downloaded_file)
-                        final_file = os.path.splitext(downloaded_file)[0] + '.mp4'
-                        os.rename(output_file, final_file)
-                        downloads[download_id]['filename'] = os.path.basename(final_file)
-                    else:
-                        # Conversion failed, keep original
-                        downloads[download_id]['filename'] = os.path.basename(downloaded_file)
-                else:
-                    downloads[download_id]['filename'] = os.path.basename(downloaded_file)
-            else:
-                # ffmpeg not available, skip conversion
-                downloads[download_id]['filename'] = os.path.basename(downloaded_file)
+            set_progress(download_id, progress=75)
+
+            if FFMPEG_AVAILABLE:
+                # Check codecs and container, using the formats yt-dlp selected.
+                # requested_downloads omits keys equal to the top-level info,
+                # so single-format results only carry codecs on info itself
+                vcodec = requested[0].get('vcodec') or info.get('vcodec')
+                acodec = requested[0].get('acodec') or info.get('acodec')
+                if not vcodec or not acodec:
+                    probed_vcodec, probed_acodec = probe_codecs(downloaded_file)
+                    vcodec = vcodec or probed_vcodec
+                    acodec = acodec or probed_acodec
+                # A codec that is still unknown is copied (remux), never re-encoded
+                copy_video = not vcodec or vcodec.startswith(MP4_VIDEO_CODECS)
+                copy_audio = not acodec or acodec == 'none' or acodec.startswith(MP4_AUDIO_CODECS)
+                is_mp4 = downloaded_file.endswith('.mp4')
+
+                if not (copy_video and copy_audio and is_mp4):
+                    # Need to convert; hand off so this worker can take the next download
+                    set_progress(download_id, status='converting')
+                    return convert_pool.submit(convert_video, download_id, downloaded_file,
+                                               copy_video, copy_audio, info.get('duration'))
+
+        set_progress(
+            download_id,
+            status='completed',
+            progress=100,
+            filename=os.path.basename(downloaded_file) if downloaded_file else None
+        )
+
+    except Exception:
+        set_progress(download_id, status='error', error='Download failed unexpectedly')
+
+
+def run_ffmpeg(download_id, input_file, output_file, codec_args, duration=None, start_pct=75):
+    """Run an ffmpeg conversion, reporting progress above start_pct.
+
+    Returns (exit code, last reported percent).
+    """
+    convert_cmd = [
+        'ffmpeg', '-i', input_file,
+        *codec_args,
+        '-movflags', '+faststart',
+        '-progress', 'pipe:1', '-nostats',
+        '-y', output_file
+    ]
+
+    convert_process = subprocess.Popen(
+        convert_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+
+    # Monitor conversion progress from ffmpeg's key=value progress report;
+    # out_time_us is the output position in microseconds
+    last_pct = start_pct
+    for line in convert_process.stdout:
+        key, _, value = line.rstrip().partition('=')
+        if key != 'out_time_us' or not value.isdigit():
+            continue
+        if duration:
+            pct = min(75 + int(20 * int(value) / 1e6 / duration), 95)
+        else:
+            pct = 85
+        # Only move forward, so a retried encode doesn't rewind the bar
+        if pct > last_pct:
+            last_pct = pct
+            set_progress(download_id, progress=pct)
+
+    return convert_process.wait(), last_pct
+
+
+def convert_video(download_id, downloaded_file, copy_video=False, copy_audio=False, duration=None):
+    """Convert a downloaded video to H.264/AAC MP4 in the conversion pool.
+
+    Streams that are already MP4-compatible are copied, so a file that only
+    needs a new container is remuxed instead of re-encoded.
+    """
+    try:
+        output_file = os.path.splitext(downloaded_file)[0] + '_converted.mp4'
+
+        if copy_audio:
+            audio_args = ['-c:a', 'copy']
+        else:
+            audio_args = ['-c:a', 'aac', '-b:a', '192k']
+
+        if copy_video:
+            returncode, _ = run_ffmpeg(download_id, downloaded_file, output_file,
+                                       ['-c:v', 'copy', *audio_args], duration)
+        else:
+            returncode, last_pct = run_ffmpeg(download_id, downloaded_file, output_file,
+                                              [*h264_video_args(H264_ENCODER), *audio_args], duration)
+            if returncode != 0 and H264_ENCODER != 'libx264':
+                # The hardware encoder can still reject a particular input
+                returncode, _ = run_ffmpeg(download_id, downloaded_file, output_file,
+                                           [*h264_video_args('libx264'), *audio_args], duration, last_pct)
+
+        if returncode == 0:
+            # Remove original, rename converted
+            os.remove(downloaded_file)
+            final_file = os.path.splitext(downloaded_file)[0] + '.mp4'
+            os.rename(output_file, final_file)
+        else:
+            # Conversion failed, keep original
+            final_file = downloaded_file
 
-        downloads[download_id]['status'] = 'completed'
-        downloads[download_id]['progress'] = 100
+        set_progress(download_id, status='completed', progress=100, filename=os.path.basename(final_file))
 
     except Exception:
-        downloads[download_id]['status'] = 'error'
-        downloads[download_id]['error'] = 'Download failed unexpectedly'
+        set_progress(download_id, status='error', error='Conversion failed unexpectedly')
+
+
+def release_download_slot(future):
+    """Free a pending-download slot once the download and any conversion are done"""
+    handoff = None if future.cancelled() or future.exception() else future.result()
+    if isinstance(handoff, Future):
+        # Hold the slot while queued/running in convert_pool so it stays bounded
+        handoff.add_done_callback(lambda _: download_slots.release())
+    else:
+        download_slots.release()
 
 
 @app.route('/')
@@ -408,6 +771,11 @@ def video_info():
     if 'error' in info:
         return jsonify(info), 400
 
+    # Only add an ellipsis when the description was actually cut
+    description = info.get('description') or ''
+    if len(description) > 200:
+        description = description[:200] + '...'
+
     # Return relevant info
     return jsonify({
         'title': info.get('title', 'Unknown'),
@@ -415,7 +783,7 @@ def video_info():
         'duration': info.get('duration', 0),
         'uploader': info.get('uploader', 'Unknown'),
         'view_count': info.get('view_count', 0),
-        'description': info.get('description', '')[:200] + '...' if info.get('description') else ''
+        'description': description
     })
 
 
@@ -440,16 +808,23 @@ def start_download():
     if format_option not in VALID_FORMATS:
         format_option = 'best'
 
+    if not download_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many downloads in progress, please try again later'}), 429
+
     # Generate secure random download ID
     download_id = f"dl_{secrets.token_urlsafe(16)}"
 
-    # Start download in background
-    thread = threading.Thread(
-        target=download_video,
-        args=(url, download_id, format_option, audio_only)
-    )
-    thread.daemon = True
-    thread.start()
+    try:
+        # Register now so progress polls work while the download waits for a worker
+        save_progress(download_id, Progress(status='queued'))
+
+        # Start download in background
+        future = download_pool.submit(download_video, url, download_id, format_option, audio_only)
+    except Exception:
+        # Nothing will release the slot for a download that never started
+        download_slots.release()
+        raise
+    future.add_done_callback(release_download_slot)
 
     return jsonify({'download_id': download_id})
 
@@ -457,28 +832,58 @@ def start_download():
 @app.route('/api/progress/<download_id>')
 def get_progress(download_id):
     """Get download progress"""
-    if download_id not in downloads:
+    progress = load_progress(download_id)
+    if progress is None:
         return jsonify({'error': 'Download not found'}), 404
 
-    return jsonify(downloads[download_id])
+    return jsonify(asdict(progress))
+
+
+# Last /api/downloads body as (DOWNLOAD_DIR mtime, JSON); any file being
+# added, renamed or removed bumps the directory mtime and invalidates it
+_list_cache = None
 
 
 @app.route('/api/downloads')
 def list_downloads():
     """List downloaded files"""
+    global _list_cache
+    dir_mtime = os.stat(DOWNLOAD_DIR).st_mtime_ns
+    cache = _list_cache
+    if cache and cache[0] == dir_mtime:
+        return Response(cache[1], mimetype='application/json')
+
     files = []
-    for filename in os.listdir(DOWNLOAD_DIR):
-        filepath = os.path.join(DOWNLOAD_DIR, filename)
-        if os.path.isfile(filepath):
-            files.append({
-                'name': filename,
-                'size': os.path.getsize(filepath),
-                'modified': os.path.getmtime(filepath)
-            })
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files.append({
+                    'name': entry.name,
+                    'size': stat.st_size,
+                    'modified': stat.st_mtime
+                })
 
     # Sort by modified time, newest first
     files.sort(key=lambda x: x['modified'], reverse=True)
-    return jsonify(files)
+    body = app.json.dumps(files)
+    _list_cache = (dir_mtime, body)
+    return Response(body, mimetype='application/json')
+
+
+def x_accel_response(filename):
+    """Build an empty response that tells nginx to send the file itself"""
+    response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = f'{X_ACCEL_REDIRECT_PREFIX}/{quote(filename)}'
+    # Same Content-Disposition encoding as send_file: ASCII fallback + RFC 5987
+    try:
+        filename.encode('ascii')
+        disposition = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        disposition = {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+^`|~')}"}
+    response.headers.set('Content-Disposition', 'attachment', **disposition)
+    return response
 
 
 @app.route('/downloads/<filename>')
@@ -488,6 +893,8 @@ def serve_download(filename):
     filepath = get_safe_filepath(filename)
     if not filepath or not os.path.isfile(filepath):
         abort(404)
+    if X_ACCEL_REDIRECT_PREFIX:
+        return x_accel_response(filename)
     return send_from_directory(DOWNLOAD_DIR, filename, as_attachment=True)
 
 
@@ -0,0 +1,17 @@
+"""gunicorn settings for the Video Downloader (used by start.sh)"""
+
+import os
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+
+# Threaded workers so progress polls, listings and info lookups run concurrently
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+# Download progress is shared through STATE_DB, so any worker can answer a
+# progress poll
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+
+# Download/convert pools live in each worker process; tell the app how many
+# there are so DOWNLOAD_WORKERS etc. stay app-wide limits
+raw_env = [f'WORKER_PROCESSES={workers}']
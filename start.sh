@@ -4,5 +4,5 @@ cd "$(dirname "$0")"
 # Activate virtual environment
 source venv/bin/activate
 
-# Start the app
-python app.py
+# Start the app (use `python app.py` for the Flask development server)
+exec gunicorn -c gunicorn.conf.py app:app